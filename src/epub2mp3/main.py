@@ -3,6 +3,7 @@ import tempfile
 import os
 import random
 from typing import Optional
+import aiohttp
 import edge_tts
 import argparse
 from .utils import (
@@ -10,11 +11,166 @@ from .utils import (
     sanitize_filename,
     ensure_output_dir,
     write_lyrics_to_mp3,
+    lyrics_tag_padding,
     convert_mp3_high_quality,
     add_bgm,
+    split_text,
+    concat_mp3,
+    list_output_files,
+    load_failed_chapters,
+    save_failed_chapters,
+    TEMP_PREFIX,
 )
 import time
 
+# 只有网络类的临时错误才值得重试，其它错误（如空文本、错误的声音名）直接失败
+RECOVERABLE_ERRORS = (
+    asyncio.TimeoutError,
+    aiohttp.ClientError,
+    edge_tts.exceptions.NoAudioReceived,
+    edge_tts.exceptions.WebSocketError,
+    ConnectionError,
+    OSError,
+)
+
+# TTS 超时按文本长度估算（约每秒 50 字），限制在 15s ~ 300s 之间
+TTS_CHARS_PER_SEC = 50
+TTS_MIN_TIMEOUT = 15
+TTS_MAX_TIMEOUT = 300
+
+# 长章节按句子切分成不超过该长度的分段分别合成，失败时只需重试单个分段
+CHUNK_CHARS = 2000
+
+
+def tts_timeout(text: str, attempt: int = 0) -> float:
+    """根据文本长度计算 TTS 超时时间，每次重试超时翻倍（不超过上限）"""
+    timeout = max(TTS_MIN_TIMEOUT, min(TTS_MAX_TIMEOUT, len(text) / TTS_CHARS_PER_SEC))
+    return min(TTS_MAX_TIMEOUT, timeout * (2**attempt))
+
+
+class CircuitOpenError(Exception):
+    """熔断器确认 TTS 服务不可用时拒绝请求"""
+
+
+class CircuitBreaker:
+    """
+    TTS 服务的熔断器，连续失败达到阈值后打开，在冷却期内暂停发出新请求；
+    冷却期过后进入半开状态放行一个探测请求，成功则关闭，失败则重新打开，
+    并让所有等待中的请求以 CircuitOpenError 快速失败
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 10, reset_timeout: float = 60.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        # 探测请求失败，说明服务确实不可用，此时不再等待而是直接失败
+        self._probe_failed = False
+        # 状态变化时唤醒等待中的请求
+        self._changed = asyncio.Event()
+
+    def allow_request(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == self.OPEN and now - self._opened_at >= self.reset_timeout:
+            # 每个冷却期只放行一个探测请求，探测结果未返回前其它请求继续等待
+            self.state = self.HALF_OPEN
+            self._opened_at = now
+            return True
+        return False
+
+    async def wait_until_allowed(self) -> bool:
+        """
+        熔断器打开时等待探测结果：探测成功则继续，探测失败则抛出 CircuitOpenError。
+        服务已确认不可用时，新请求在下一个冷却期结束前直接失败。
+        返回 True 表示本次请求就是探测请求，调用方结束后必须调用 release_probe()
+        """
+        while not self.allow_request():
+            if self._probe_failed:
+                raise CircuitOpenError(
+                    "TTS service unavailable, circuit breaker is open"
+                )
+            # 半开状态下等待探测结果，打开状态下最多等到冷却期结束
+            timeout = None
+            if self.state == self.OPEN:
+                elapsed = time.monotonic() - self._opened_at
+                timeout = max(self.reset_timeout - elapsed, 0)
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=timeout)
+            except TimeoutError:
+                pass
+        return self.state == self.HALF_OPEN
+
+    def release_probe(self) -> None:
+        """
+        探测请求结束时调用。如果探测既未成功也未以可恢复错误失败（不可恢复错误、被取消），
+        回到打开状态并让下一个请求立即重新探测，避免卡在半开状态
+        """
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+            self._opened_at = time.monotonic() - self.reset_timeout
+            self._notify()
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def record_success(self) -> None:
+        self._failures = 0
+        self._probe_failed = False
+        if self.state != self.CLOSED:
+            self.state = self.CLOSED
+            self._notify()
+
+    def record_failure(self) -> None:
+        if self.state == self.OPEN:
+            # 打开前已发出的请求陆续失败，不影响状态
+            return
+        if self.state == self.HALF_OPEN:
+            self._probe_failed = True
+        else:
+            self._failures += 1
+            if self._failures < self.failure_threshold:
+                return
+            print(f"Circuit breaker opened after {self._failures} failures")
+            self._failures = 0
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._notify()
+
+
+class SharedTCPConnector(aiohttp.TCPConnector):
+    """
+    在多个 edge_tts 会话之间共享的 connector（复用 DNS 缓存和连接池）。
+    edge_tts 每次都新建 ClientSession，会话结束时会关闭 connector，
+    这里忽略这些关闭请求，由转换器在结束时调用 close_shared() 真正关闭
+    """
+
+    def close(self, *, abort_ssl: bool = False):
+        return asyncio.sleep(0)
+
+    def close_shared(self):
+        return super().close()
+
+
+async def _ffmpeg_postprocess(
+    mp3_path: str, bg_path: Optional[str], id3_padding: int = -1
+) -> None:
+    """后处理: 添加背景音乐/提升码率"""
+    # 有背景音乐时混音和高码率编码一次完成，失败则退回单独转码
+    mixed = False
+    if bg_path:
+        # 主音频刚生成，背景音乐在初始化时已确认存在，无需再检查
+        mixed = await add_bgm(mp3_path, bg_path, verify=False, id3_padding=id3_padding)
+    if not mixed:
+        await convert_mp3_high_quality(mp3_path, id3_padding=id3_padding)
+
 
 class EpubToMP3Converter:
     def __init__(
@@ -23,10 +179,24 @@ class EpubToMP3Converter:
         output_dir: str,
         max_retries: int = 3,
         bg_dir=None,
+        max_concurrent: int = 10,
+        base_delay: float = 1.0,
+        max_delay: float = 30.0,
+        jitter: float = 0.5,
     ):
         self.voice = voice
         self.output_dir = output_dir
         self.max_retries = max_retries
+        # 指数退避参数，jitter 用于打散并发章节的重试时间，避免同时重试
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        # 用计数器 + Condition 限制同时进行的 TTS 会话数，便于运行时调整并发
+        self.max_concurrent = max_concurrent
+        self._active = 0
+        self._cond = asyncio.Condition()
+        self._breaker = CircuitBreaker()
+        self._connector = None
         self.bg_files = None
         if bg_dir and os.path.isdir(bg_dir):
             self.bg_files = [
@@ -37,31 +207,122 @@ class EpubToMP3Converter:
             ]
         ensure_output_dir(output_dir)
 
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        """释放共享的 TTS 连接"""
+        if self._connector is not None:
+            await self._connector.close_shared()
+            self._connector = None
+
+    def _get_connector(self) -> SharedTCPConnector:
+        # connector 需要在事件循环中创建，所以延迟到第一次 TTS 请求时
+        if self._connector is None:
+            self._connector = SharedTCPConnector(ttl_dns_cache=300)
+        return self._connector
+
+    async def set_concurrency(self, n: int) -> None:
+        """运行时调整最大并发 TTS 会话数，调小时已在进行的会话不受影响"""
+        if n < 1:
+            raise ValueError(f"concurrency must be >= 1, got {n}")
+        async with self._cond:
+            self.max_concurrent = n
+            self._cond.notify_all()
+
+    async def _acquire_slot(self) -> None:
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._active < self.max_concurrent)
+            self._active += 1
+
+    async def _release_slot(self) -> None:
+        async with self._cond:
+            self._active -= 1
+            self._cond.notify(1)
+
+    async def _gather_bounded(self, coros, limit: int):
+        """并发执行协程，但同时运行的数量不超过 limit"""
+        sem = asyncio.Semaphore(limit)
+
+        async def run(c):
+            async with sem:
+                return await c
+
+        return await asyncio.gather(*(run(c) for c in coros))
+
     async def text_to_speech_with_retry(self, text: str, output_file: str) -> None:
         """将文本转换为语音，带重试机制"""
         last_exception = None
 
         for attempt in range(self.max_retries):
+            # 熔断期间在这里等待探测结果，不占用 TTS 并发名额；
+            # 探测失败时抛出 CircuitOpenError，章节直接失败而不再重试
+            is_probe = await self._breaker.wait_until_allowed()
             try:
-                print(f"[{output_file}] Attempt {attempt + 1}/{self.max_retries}")
-                communicate = edge_tts.Communicate(text, self.voice)
-                await communicate.save(output_file)
-                print(f"[{output_file}] Conversion successful")
-                return
+                await self._acquire_slot()
+                try:
+                    print(f"[{output_file}] Attempt {attempt + 1}/{self.max_retries}")
+                    communicate = edge_tts.Communicate(
+                        text, self.voice, connector=self._get_connector()
+                    )
+                    await asyncio.wait_for(
+                        communicate.save(output_file),
+                        timeout=tts_timeout(text, attempt),
+                    )
+                    self._breaker.record_success()
+                    print(f"[{output_file}] Conversion successful")
+                    return
 
-            except Exception as e:
-                last_exception = e
-                print(f"[{output_file}] Attempt {attempt + 1} failed: {str(e)}")
+                except Exception as e:
+                    last_exception = e
+                    print(f"[{output_file}] Attempt {attempt + 1} failed: {str(e)}")
+                    if not isinstance(e, RECOVERABLE_ERRORS):
+                        print(f"[{output_file}] Unrecoverable error, giving up")
+                        raise
+                    self._breaker.record_failure()
+                finally:
+                    await self._release_slot()
+            finally:
+                # 探测请求无论以何种方式结束，都不能让熔断器停留在半开状态
+                if is_probe:
+                    self._breaker.release_probe()
 
             # 如果失败了,等待后重试
             if attempt < self.max_retries - 1:  # 如果不是最后一次尝试
-                wait_time = 2**attempt
-                print(f"[{output_file}] Waiting {wait_time}s before retry")
+                wait_time = min(self.max_delay, self.base_delay * (2**attempt))
+                wait_time *= 1 + random.random() * self.jitter
+                print(f"[{output_file}] Waiting {wait_time:.2f}s before retry")
                 await asyncio.sleep(wait_time)
 
         print(f"[{output_file}] All attempts failed")
         raise last_exception
 
+    async def text_to_speech_chunked(self, text: str, output_file: str) -> None:
+        """长文本切分为多段并发合成，再无损拼接为一个文件"""
+        chunks = split_text(text, CHUNK_CHARS)
+        if len(chunks) <= 1:
+            await self.text_to_speech_with_retry(text, output_file)
+            return
+
+        base, _ = os.path.splitext(output_file)
+        part_files = [f"{base}_part_{i:02d}.mp3" for i in range(len(chunks))]
+        try:
+            # 任一分段失败时 TaskGroup 会取消其余分段并等待它们结束，再清理分段文件
+            try:
+                async with asyncio.TaskGroup() as tg:
+                    for chunk, part_file in zip(chunks, part_files):
+                        tg.create_task(self.text_to_speech_with_retry(chunk, part_file))
+            except ExceptionGroup as eg:
+                raise eg.exceptions[0]
+            await concat_mp3(part_files, output_file)
+        finally:
+            for part_file in part_files:
+                if os.path.exists(part_file):
+                    os.remove(part_file)
+
     async def convert_epub(self, epub_path: str) -> None:
         """转换 EPUB 文件为 MP3"""
         if not os.path.exists(epub_path):
@@ -69,7 +330,11 @@ class EpubToMP3Converter:
 
         chapters = get_chapters(epub_path)
         tasks = []
+        retry_tasks = []
         failed_chapters = []
+        # 一次 scandir 取得所有已生成文件，避免每章都 stat 一次
+        existing = list_output_files(self.output_dir)
+        previously_failed = set(load_failed_chapters(self.output_dir))
 
         for i, (title, content) in enumerate(chapters, 1):
             safe_title = sanitize_filename(title)
@@ -79,16 +344,19 @@ class EpubToMP3Converter:
             print(f"Processing chapter {i}: {title}")
 
             # 如果文件已存在且大小正常，跳过处理
-            if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+            if existing.get(filename, 0) > 0:
                 print(f"Chapter {i} already exists, skipping...")
                 continue
 
-            task = asyncio.create_task(
-                self.process_chapter(i, title, content, output_path, failed_chapters)
-            )
-            tasks.append(task)
+            # 上次失败的章节排在前面优先重试
+            task = self.process_chapter(i, title, content, output_path, failed_chapters)
+            if i in previously_failed:
+                retry_tasks.append(task)
+            else:
+                tasks.append(task)
 
-        await asyncio.gather(*tasks)
+        await self._gather_bounded(retry_tasks + tasks, self.max_concurrent)
+        save_failed_chapters(self.output_dir, failed_chapters)
 
         # 报告失败的章节
         if failed_chapters:
@@ -105,24 +373,36 @@ class EpubToMP3Converter:
         failed_chapters: list,
     ) -> None:
         """处理单个章节的转换，包含错误处理"""
+        temp_output = None
+        succeeded = False
         try:
-            with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as tmp_file:
+            # 临时文件与最终文件放在同一目录，最后的 os.replace 不会跨文件系统复制
+            with tempfile.NamedTemporaryFile(
+                prefix=TEMP_PREFIX, suffix=".mp3", delete=False, dir=self.output_dir
+            ) as tmp_file:
                 temp_output = tmp_file.name
 
-            await self.text_to_speech_with_retry(content, temp_output)
+            await self.text_to_speech_chunked(content, temp_output)
+            bg_path = None
             if self.bg_files and len(self.bg_files) > 0:
                 bg_path = random.choice(self.bg_files)
-                add_bgm(temp_output, bg_path)
-            convert_mp3_high_quality(temp_output)
+            # ffmpeg 以异步子进程运行，编码时其它章节的 TTS 仍可继续
+            # 编码时为歌词标签预留空间，随后写入歌词时不必重写整个文件
+            await _ffmpeg_postprocess(temp_output, bg_path, lyrics_tag_padding(content))
             write_lyrics_to_mp3(temp_output, content)
 
             os.replace(temp_output, output_path)
+            succeeded = True
 
             print(f"Successfully converted chapter {index}: {title}")
         except Exception as e:
             print(f"Failed to convert chapter {index}: {title}")
             print(f"Error: {str(e)}")
             failed_chapters.append(index)
+        finally:
+            # 失败、取消或 Ctrl-C 时都清理临时文件
+            if not succeeded and temp_output and os.path.exists(temp_output):
+                os.remove(temp_output)
 
 
 def main():
@@ -169,6 +449,14 @@ def main():
         help="背景音乐文件所在目录，如果指定，程序会随机选择一个背景音乐添加到每个章节的音频中。\n默认不添加背景音乐。",
     )
 
+    parser.add_argument(
+        "-c",
+        "--concurrent",
+        type=int,
+        default=10,
+        help="同时处理的最大章节数。\n默认值: 10",
+    )
+
     args = parser.parse_args()
 
     converter = EpubToMP3Converter(
@@ -176,10 +464,15 @@ def main():
         output_dir=args.output_dir,
         max_retries=args.retries,
         bg_dir=args.bg_dir if "bg_dir" in args else None,
+        max_concurrent=args.concurrent,
     )
 
+    async def run():
+        async with converter:
+            await converter.convert_epub(args.epub_path)
+
     try:
-        asyncio.run(converter.convert_epub(args.epub_path))
+        asyncio.run(run())
         print("\n转换完成！")
         print(f"所有音频文件已保存到目录: {os.path.abspath(args.output_dir)}")
     except FileNotFoundError as e:
@@ -193,4 +486,12 @@ def main():
 if __name__ == "__main__":
     if os.name == "nt":
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    else:
+        # 安装了 uvloop 时使用基于 libuv 的事件循环，降低大量并发 TTS 流的调度开销
+        try:
+            import uvloop
+
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        except ImportError:
+            pass
     main()
@@ -1,47 +1,119 @@
 import re
 import os
+import asyncio
+import json
+import hashlib
 import tempfile
 import subprocess
-from typing import Tuple, List
-from bs4 import BeautifulSoup
+import warnings
+from typing import Dict, Tuple, List
+from bs4 import BeautifulSoup, XMLParsedAsHTMLWarning
 import ebooklib
 from ebooklib import epub
 from mutagen.mp3 import MP3
 from mutagen.id3 import ID3, USLT, Encoding
 from imageio_ffmpeg import get_ffmpeg_exe
 
+_TAG_RE = re.compile(r"<[^>]*>")
+_FNAME_RE = re.compile(r'[<>:"/\\|?*]')
+_SENTENCE_END_RE = re.compile(r"(?<=[。！？.!?\n])")
+
+# 临时文件与输出文件放在同一目录，使用隐藏前缀，避免被当成章节音频
+TEMP_PREFIX = ".epub2mp3_"
+
 
 def clean_html(raw_html: str) -> str:
     """清理 HTML 标签，只保留文本内容"""
-    cleanr = re.compile("<.*?>")
-    cleantext = re.sub(cleanr, "", raw_html)
-    return cleantext.strip()
+    return _TAG_RE.sub("", raw_html).strip()
+
+
+def split_text(text: str, max_chars: int) -> List[str]:
+    """按句子边界把文本切分为不超过 max_chars 的若干段，单句过长时强制截断"""
+    chunks = []
+    current = ""
+    for sentence in _SENTENCE_END_RE.split(text):
+        while len(sentence) > max_chars:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(sentence[:max_chars])
+            sentence = sentence[max_chars:]
+        if len(current) + len(sentence) > max_chars:
+            chunks.append(current)
+            current = ""
+        current += sentence
+    if current.strip():
+        chunks.append(current)
+    return [chunk for chunk in chunks if chunk.strip()]
 
 
 def sanitize_filename(filename: str) -> str:
     """清理文件名，移除非法字符"""
-    return re.sub(r'[<>:"/\\|?*]', "", filename)
+    return _FNAME_RE.sub("", filename)
+
+
+# 章节解析结果的缓存目录，解析逻辑变化时需要递增版本号让旧缓存失效
+CHAPTERS_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "epub2mp3"
+)
+CHAPTERS_CACHE_VERSION = 3
+
+
+def _chapters_cache_path(epub_path: str) -> str:
+    """根据 EPUB 路径、修改时间和大小计算缓存文件路径"""
+    path = os.path.abspath(epub_path)
+    raw = (
+        f"{CHAPTERS_CACHE_VERSION}:{path}"
+        f"{os.path.getmtime(path)}{os.path.getsize(path)}"
+    )
+    key = hashlib.blake2b(raw.encode()).hexdigest()
+    return os.path.join(CHAPTERS_CACHE_DIR, f"{key}.json")
 
 
 def get_chapters(epub_path: str) -> List[Tuple[str, str]]:
-    """从 EPUB 文件中提取章节内容"""
+    """从 EPUB 文件中提取章节内容，结果缓存到磁盘，EPUB 未变化时直接读取缓存"""
+    cache_path = _chapters_cache_path(epub_path)
+    try:
+        with open(cache_path, encoding="utf-8") as f:
+            return [(title, content) for title, content in json.load(f)]
+    except (OSError, ValueError, TypeError):
+        pass
+
+    chapters = parse_chapters(epub_path)
+
+    try:
+        ensure_output_dir(CHAPTERS_CACHE_DIR)
+        with open(cache_path, "w", encoding="utf-8") as f:
+            json.dump(chapters, f, ensure_ascii=False)
+    except OSError as e:
+        print(f"[{cache_path}] 写入章节缓存失败: {e}")
+
+    return chapters
+
+
+def parse_chapters(epub_path: str) -> List[Tuple[str, str]]:
+    """解析 EPUB 文件，提取章节内容"""
     book = epub.read_epub(epub_path)
     chapters = []
 
-    for item in book.get_items():
-        if item.get_type() == ebooklib.ITEM_DOCUMENT:
-            soup = BeautifulSoup(item.get_content(), "html.parser")
+    for item in book.get_items_of_type(ebooklib.ITEM_DOCUMENT):
+        # EPUB 章节是 XHTML，用 lxml 的 HTML 解析器解析时 bs4 会发出警告，这里忽略
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", XMLParsedAsHTMLWarning)
+            soup = BeautifulSoup(item.get_content(), "lxml")
 
-            title = soup.find(["h1", "h2", "h3"])
-            if title:
-                title = clean_html(str(title))
-            else:
-                title = f"Chapter_{len(chapters) + 1}"
+        # 正文一次遍历提取，空文档直接跳过，不再查找标题
+        content = soup.body.get_text(" ", strip=True) if soup.body else ""
+        if not content:
+            continue
 
-            content = clean_html(str(soup.body))
+        title = soup.body.find(["h1", "h2", "h3"])
+        if title:
+            title = title.get_text(" ", strip=True)
+        else:
+            title = f"Chapter_{len(chapters) + 1}"
 
-            if content.strip():
-                chapters.append((title, content))
+        chapters.append((title, content))
 
     return chapters
 
@@ -52,6 +124,41 @@ def ensure_output_dir(output_dir: str) -> None:
         os.makedirs(output_dir)
 
 
+def list_output_files(output_dir: str) -> Dict[str, int]:
+    """一次遍历输出目录，返回 {文件名: 大小}"""
+    with os.scandir(output_dir) as entries:
+        return {
+            entry.name: entry.stat().st_size for entry in entries if entry.is_file()
+        }
+
+
+# 记录上次运行失败章节的文件，下次运行时优先重试这些章节
+FAILED_CHAPTERS_FILE = ".epub2mp3_failed.json"
+
+
+def load_failed_chapters(output_dir: str) -> List[int]:
+    """读取上次运行失败的章节序号"""
+    path = os.path.join(output_dir, FAILED_CHAPTERS_FILE)
+    try:
+        with open(path, encoding="utf-8") as f:
+            return [int(i) for i in json.load(f)]
+    except (OSError, ValueError, TypeError):
+        return []
+
+
+def save_failed_chapters(output_dir: str, failed_chapters: List[int]) -> None:
+    """保存本次运行失败的章节序号，全部成功时删除记录文件"""
+    path = os.path.join(output_dir, FAILED_CHAPTERS_FILE)
+    try:
+        if failed_chapters:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(sorted(failed_chapters), f)
+        elif os.path.exists(path):
+            os.remove(path)
+    except OSError as e:
+        print(f"[{path}] 保存失败章节记录失败: {e}")
+
+
 def make_lrc_lines_by_duration(text: str, duration_sec: int):
     """
     生成LRC歌词，将所有歌词放在第一秒到最后一秒之间显示，去除换行符
@@ -81,6 +188,19 @@ def make_lrc_lines_by_duration(text: str, duration_sec: int):
     return f"{start_tag}{cleaned_text}\n{end_tag}"
 
 
+def lyrics_tag_padding(lyrics_text: str) -> int:
+    """估算写入歌词所需的 ID3 预留空间（字节），ffmpeg 编码时预留后可原地写入歌词"""
+    # 歌词文本 UTF-8 长度，加上时间标签和 USLT 帧头等开销
+    return len(" ".join(lyrics_text.split()).encode("utf-8")) + 1024
+
+
+def _keep_id3_padding(info) -> int:
+    """mutagen 的 padding 策略: 剩余空间足够时保持原大小，否则使用默认策略扩容"""
+    if info.padding >= 0:
+        return info.padding
+    return info.get_default_padding()
+
+
 def write_lyrics_to_mp3(mp3_path: str, lyrics_text: str):
     """将文本作为带均匀时间标签的歌词写入mp3的歌词标签"""
     try:
@@ -97,23 +217,73 @@ def write_lyrics_to_mp3(mp3_path: str, lyrics_text: str):
         audio.tags.add(
             USLT(encoding=Encoding.UTF8, lang="chi", desc="epub2mp3", text=lrc_text)
         )
-        audio.save()
+        # 标签能放进已有的 ID3 预留空间时原地写入，不重写整个 mp3 文件
+        audio.save(padding=_keep_id3_padding)
         print(f"[{mp3_path}] 歌词标签写入成功")
     except Exception as e:
         print(f"[{mp3_path}] 写入歌词标签失败: {e}")
 
 
-def convert_mp3_high_quality(input_mp3, bitrate="320k", samplerate="48000"):
+def mp3_meets_quality(mp3_path: str, bitrate="320k", samplerate="48000") -> bool:
+    """检查mp3的码率和采样率是否已经不低于目标值"""
+    target_bitrate = int(bitrate.lower().rstrip("k")) * 1000
+    try:
+        info = MP3(mp3_path).info
+    except Exception:
+        return False
+    return info.bitrate >= target_bitrate and info.sample_rate >= int(samplerate)
+
+
+async def run_ffmpeg(cmd: List[str]) -> None:
+    """
+    异步执行ffmpeg命令，不阻塞事件循环
+    失败时抛出 subprocess.CalledProcessError，stderr 为ffmpeg的错误输出
+    """
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+        )
+    except NotImplementedError:
+        # Windows 上的 SelectorEventLoop 不支持子进程，改为在线程中执行
+        await asyncio.to_thread(
+            subprocess.run,
+            cmd,
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        return
+    _, stderr = await proc.communicate()
+    if proc.returncode:
+        raise subprocess.CalledProcessError(
+            proc.returncode, cmd, stderr=stderr.decode(errors="replace")
+        )
+
+
+async def convert_mp3_high_quality(
+    input_mp3, bitrate="320k", samplerate="48000", id3_padding: int = -1
+):
     """
     用ffmpeg把mp3转为最高比特率和采样率（如320kbps/48kHz）
-    直接修改原始文件
+    直接修改原始文件，如果已经达到目标码率和采样率则跳过
+    id3_padding 为 ID3 标签预留的空间（字节），-1 表示使用 ffmpeg 默认值
     """
+    if mp3_meets_quality(input_mp3, bitrate, samplerate):
+        print(f"[{input_mp3}] 已是 {bitrate}, {samplerate}Hz，跳过转码")
+        return
+
     try:
         # 获取ffmpeg可执行文件路径
         ffmpeg_path = get_ffmpeg_exe()
 
-        # 在临时目录创建临时文件
-        with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as tmp_file:
+        # 在原文件所在目录创建临时文件，保证 os.replace 只是同一文件系统内的重命名
+        with tempfile.NamedTemporaryFile(
+            prefix=TEMP_PREFIX,
+            suffix=".mp3",
+            delete=False,
+            dir=os.path.dirname(os.path.abspath(input_mp3)),
+        ) as tmp_file:
             temp_output = tmp_file.name
 
         cmd = [
@@ -127,13 +297,13 @@ def convert_mp3_high_quality(input_mp3, bitrate="320k", samplerate="48000"):
             bitrate,
             "-map_metadata",
             "0",
+            "-metadata_header_padding",
+            str(id3_padding),
             temp_output,
         ]
 
         # 执行命令
-        subprocess.run(
-            cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
-        )
+        await run_ffmpeg(cmd)
 
         # 用临时文件替换原文件
         os.replace(temp_output, input_mp3)
@@ -141,24 +311,71 @@ def convert_mp3_high_quality(input_mp3, bitrate="320k", samplerate="48000"):
         print(f"[{input_mp3}] 已提升到 {bitrate}, {samplerate}Hz")
 
     except Exception as e:
-        # 确保清理临时文件
-        if "temp_output" in locals():
+        print(f"[{input_mp3}] 码率/采样率提升失败: {e}")
+    finally:
+        # 确保清理临时文件（包括任务被取消的情况），成功时它已被 os.replace 移走
+        if "temp_output" in locals() and os.path.exists(temp_output):
             try:
                 os.remove(temp_output)
-            except:
+            except OSError:
                 pass
-        print(f"[{input_mp3}] 码率/采样率提升失败: {e}")
 
 
-def add_bgm(
+async def concat_mp3(input_mp3s: List[str], output_mp3: str) -> None:
+    """
+    用ffmpeg的concat分离器无损拼接多个mp3（-c copy，不重新编码）
+    失败时抛出 subprocess.CalledProcessError
+    """
+    ffmpeg_path = get_ffmpeg_exe()
+
+    # concat 列表文件与输出放在同一目录，路径中的单引号需要转义
+    with tempfile.NamedTemporaryFile(
+        "w",
+        prefix=TEMP_PREFIX,
+        suffix=".txt",
+        delete=False,
+        encoding="utf-8",
+        dir=os.path.dirname(os.path.abspath(output_mp3)),
+    ) as list_file:
+        for path in input_mp3s:
+            escaped = os.path.abspath(path).replace("'", "'\\''")
+            list_file.write(f"file '{escaped}'\n")
+        list_path = list_file.name
+
+    try:
+        cmd = [
+            ffmpeg_path,
+            "-y",
+            "-f",
+            "concat",
+            "-safe",
+            "0",
+            "-i",
+            list_path,
+            "-c",
+            "copy",
+            output_mp3,
+        ]
+        await run_ffmpeg(cmd)
+        print(f"[{output_mp3}] 已拼接 {len(input_mp3s)} 个分段")
+    finally:
+        os.remove(list_path)
+
+
+async def add_bgm(
     main_audio: str,
     bgm_audio: str,
     main_volume: float = 1.0,
     bgm_volume: float = 0.25,
     loop_bgm: bool = True,
+    target_bitrate: str = "320k",
+    target_samplerate: str = "48000",
+    verify: bool = True,
+    id3_padding: int = -1,
 ):
     """
     使用 FFMPEG 为主音频文件添加背景音乐，并直接覆盖原文件。
+    混音和最终的码率/采样率编码在同一次 FFMPEG 调用中完成，无需再调用 convert_mp3_high_quality。
 
     警告: 此操作会修改 `main_audio` 文件，建议在操作前进行备份。
 
@@ -168,22 +385,33 @@ def add_bgm(
         main_volume (float, optional): 主音频的音量 (1.0 代表原始音量)。默认为 1.0。
         bgm_volume (float, optional): 背景音乐的音量。默认为 0.25。
         loop_bgm (bool, optional): 如果背景音乐比主音频短，是否循环。默认为 True。
+        target_bitrate (str, optional): 输出码率。默认为 "320k"。
+        target_samplerate (str, optional): 输出采样率。默认为 "48000"。
+        verify (bool, optional): 是否先检查输入文件是否存在，调用方已确认时可关闭。默认为 True。
+        id3_padding (int, optional): 为 ID3 标签预留的空间（字节），-1 表示使用 ffmpeg 默认值。默认为 -1。
 
     Returns:
         bool: 如果成功返回 True，否则返回 False。
     """
     # 1. 检查输入文件是否存在
-    if not os.path.exists(main_audio):
-        print(f"错误: 主音频文件未找到 -> {main_audio}")
-        return False
-    if not os.path.exists(bgm_audio):
-        print(f"错误: 背景音乐文件未找到 -> {bgm_audio}")
-        return False
+    if verify:
+        if not os.path.exists(main_audio):
+            print(f"错误: 主音频文件未找到 -> {main_audio}")
+            return False
+        if not os.path.exists(bgm_audio):
+            print(f"错误: 背景音乐文件未找到 -> {bgm_audio}")
+            return False
 
     # 2. 创建一个安全的临时文件来存放混合后的输出
     # 使用 tempfile 模块可以保证文件名唯一，避免冲突
     # delete=False 让我们能控制何时删除它
-    temp_file = tempfile.NamedTemporaryFile(suffix=".mp3", delete=False)
+    # 放在主音频所在目录，保证 os.replace 只是同一文件系统内的重命名
+    temp_file = tempfile.NamedTemporaryFile(
+        prefix=TEMP_PREFIX,
+        suffix=".mp3",
+        delete=False,
+        dir=os.path.dirname(os.path.abspath(main_audio)),
+    )
     temp_output_path = temp_file.name
     temp_file.close()  # 关闭文件句柄，以便 FFMPEG 可以写入
 
@@ -212,10 +440,14 @@ def add_bgm(
                 filter_complex,
                 "-map",
                 "[out]",
+                "-ar",
+                target_samplerate,
+                "-b:a",
+                target_bitrate,
                 "-c:a",
                 "libmp3lame",
-                "-b:a",
-                "192k",
+                "-metadata_header_padding",
+                str(id3_padding),
                 "-y",
                 temp_output_path,  # 输出到临时文件
             ]
@@ -225,7 +457,7 @@ def add_bgm(
         print("正在混合音频到临时文件...")
         print(" ".join(command))
 
-        result = subprocess.run(command, check=True, capture_output=True, text=True)
+        await run_ffmpeg(command)
 
         # 5. 如果 FFMPEG 成功，用临时文件替换原始文件
         print("混合成功。正在替换原始文件...")